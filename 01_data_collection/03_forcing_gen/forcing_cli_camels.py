@@ -19,7 +19,6 @@ from pathlib import Path
 import shutil
 import json
 import geopandas as gpd
-import xarray as xr
 import os
 # from memory_profiler import profile
 
@@ -96,6 +95,12 @@ def parse_arguments() -> argparse.Namespace:
         help=f"End date for forcings/realization (format {DATE_FORMAT_HINT})",
         required=True,
     )
+    parser.add_argument(
+        "--shared_cache",
+        type=Path,
+        help="path to a zarr store of raw gridded data shared by all basins, only the data "
+        "around each basin that isn't in it yet is downloaded into it",
+    )
     parser.add_argument(
         "-D",
         "--debug",
@@ -120,15 +125,13 @@ def process_catchment(geometries_dict, output_dir, camels_basin, merged_data):
             forcing_working_dir.mkdir(parents=True, exist_ok=True)
             logging.debug("Created working directory: %s", forcing_working_dir)
 
-        temp_dir = forcing_working_dir / "temp"
-        if not temp_dir.exists():
-            temp_dir.mkdir(parents=True, exist_ok=True)
         geometries_dict = geometries_dict.to_crs(merged_data.crs.esri_pe_string)
         print(geometries_dict.dtypes)
         compute_zonal_stats(geometries_dict, merged_data, forcing_working_dir)
         logging.debug("Computed zonal stats for %s", camels_basin)
 
-        shutil.copy(forcing_working_dir / "forcings.nc", output_file)
+        # a rename on the same filesystem, the file isn't copied
+        shutil.move(forcing_working_dir / "forcings.nc", output_file)
         logging.info("Created forcings file: %s", output_file)
         # remove the working directory
         shutil.rmtree(forcing_working_dir)
@@ -191,26 +194,33 @@ def main() -> None:
         total_gdf = gpd.GeoDataFrame(crs="EPSG:4326", geometry=[total_geometries])
 
         # get raw gridded data for entire upstream region of basin
-        cached_nc_path = Path(f"raw_output/{k}-raw-gridded-data.nc")
+        cached_nc_path = Path(f"raw_output/{k}-raw-gridded-data.zarr")
         aggregated_nc_path = Path(f"outputcamels/{k}/{k}-aggregated.nc")
         if not aggregated_nc_path.exists():
-            if not cached_nc_path.exists():
+            if args.shared_cache:
+                merged_data = get_forcing_data(args.shared_cache,
+                                               start_time,
+                                               end_time,
+                                               total_gdf,
+                                               region_write=True)
+            else:
+                # an existing cache holds the source chunks around the bounds,
+                # get_forcing_data clips it to the bounds without downloading
                 logging.debug("cached nc path: %s", cached_nc_path)
                 merged_data = get_forcing_data(cached_nc_path,
                                             start_time,
                                             end_time,
                                             total_gdf)
-            else:
-                merged_data = xr.open_dataset(cached_nc_path)
-                # process the catchment and all its upstreams
+
+            # process the catchment and all its upstreams
 
             process_catchment(gdf_id, args.output_dir, camels_basin, merged_data)
 
         
         if cached_nc_path.exists():
-            # remove the cached nc file
-            cached_nc_path.unlink()
-            logging.debug("Removing cached nc file: %s", cached_nc_path)
+            # remove the cached zarr store
+            shutil.rmtree(cached_nc_path)
+            logging.debug("Removing cached zarr store: %s", cached_nc_path)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1 @@
+"""Modules used by forcing_cli_camels.py to generate the forcing data."""
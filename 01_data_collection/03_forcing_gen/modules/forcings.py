@@ -14,15 +14,18 @@ Adapted by Quinn Lee (GitHub @quinnylee)
 
 import logging
 import multiprocessing
+import os
 import time
 import warnings
+from contextlib import contextmanager
 from functools import partial
 from math import ceil
 from multiprocessing import shared_memory
 from pathlib import Path
 from typing import Tuple
-from dask.distributed import Client, LocalCluster
+import dask.array
 import geopandas as gpd
+import netCDF4
 import numpy as np
 import pandas as pd
 import psutil
@@ -31,6 +34,7 @@ import xarray as xr
 # from data_processing.zarr_utils import get_forcing_data
 from exactextract import exact_extract
 from exactextract.raster import NumPyRasterSource
+from numba import njit, prange, set_num_threads
 from rich.progress import (
     Progress,
     BarColumn,
@@ -38,9 +42,12 @@ from rich.progress import (
     TimeElapsedColumn,
     TimeRemainingColumn,
 )
+from .packing import clip_to_packing_range, get_packing, pack
 
 
 logger = logging.getLogger(__name__)
+# number of timesteps per chunk in the final forcings file
+OUTPUT_TIME_CHUNK = 4096
 # Suppress the specific warning from numpy to keep the cli output clean
 warnings.filterwarnings(
     "ignore", message="'DataFrame.swapaxes' is deprecated", category=FutureWarning
@@ -50,40 +57,55 @@ warnings.filterwarnings(
 )
 
 
+@njit(parallel=True, fastmath={"reassoc", "contract"}, cache=True, boundscheck=False)
 def weighted_sum_of_cells(flat_raster: np.ndarray,
+                          offsets: np.ndarray,
                           cell_ids: np.ndarray,
-                          factors: np.ndarray) -> np.ndarray:
-    '''  
-    Take an average of each forcing variable in a catchment. Create an output
-    array initialized with zeros, and then sum up the forcing variable and 
-    divide by the sum of the cell weights to get an averaged forcing variable 
-    for the entire catchment.
+                          weights: np.ndarray,
+                          inv_weight_sums: np.ndarray,
+                          out: np.ndarray) -> None:
+    '''
+    Take an average of each forcing variable in every catchment of a chunk.
+    The gather, multiply, sum and division by the sum of the cell weights are
+    fused into one pass over the raster, so no temporary arrays are created.
 
     Parameters
     ----------
     flat_raster : np.ndarray
-        An array of dimensions (time, x*y) containing forcing variable values
-        in each cell. Each element in the array corresponds to a cell ID.
+        A float32 array of dimensions (x*y, time) containing forcing variable
+        values in each cell. Each row in the array corresponds to a cell ID.
+    offsets : np.ndarray
+        The cells of the i-th catchment are cell_ids[offsets[i]:offsets[i + 1]].
     cell_ids : np.ndarray
-        A list of the raster cell IDs that intersect the study catchment.
-    factors : np.ndarray
-        A list of the weights (coverages) of each cell in cell_ids.
-
-    Returns
-    -------
-    np.ndarray
-        An one-dimensional array, where each element corresponds to a timestep.
-        Each element contains the averaged forcing value for the whole catchment
-        over one timestep.
+        The raster cell IDs that intersect the catchments.
+    weights : np.ndarray
+        The weights (coverages) of each cell in cell_ids.
+    inv_weight_sums : np.ndarray
+        One over the sum of the weights of each catchment.
+    out : np.ndarray
+        Array of dimensions (# catchments, time) that receives the averaged
+        forcing value for each catchment over each timestep.
     '''
-    result = np.zeros(flat_raster.shape[0])
-    result = np.sum(flat_raster[:, cell_ids] * factors, axis=1)
-    sum_of_weights = np.sum(factors)
-    result /= sum_of_weights
-    return result
-
-
-def get_cell_weights(raster: xr.Dataset,
+    n_catchments = offsets.shape[0] - 1
+    n_time = flat_raster.shape[1]
+    # fastmath is limited to reassociation and FMA contraction, missing cells
+    # are NaN and have to keep propagating into the mean
+    for c in prange(n_catchments):
+        # the sums are accumulated in the catchment's row of out, so no array
+        # is allocated per catchment
+        for t in range(n_time):
+            out[c, t] = 0
+        # every cell is a contiguous row of timesteps
+        for k in range(offsets[c], offsets[c + 1]):
+            cell = cell_ids[k]
+            weight = weights[k]
+            for t in range(n_time):
+                out[c, t] += flat_raster[cell, t] * weight
+        for t in range(n_time):
+            out[c, t] *= inv_weight_sums[c]
+
+
+def get_cell_weights(raster: xr.DataArray,
                      gdf: gpd.GeoDataFrame,
                      wkt: str) -> pd.DataFrame:
     '''
@@ -93,8 +115,9 @@ def get_cell_weights(raster: xr.Dataset,
 
     Parameters
     ----------
-    raster : xr.Dataset
-        One timestep of a gridded forcings dataset.
+    raster : xr.DataArray
+        One timestep of one variable of a gridded forcings dataset, only its
+        grid is used.
     gdf : gpd.GeoDataFrame
         A GeoDataFrame with a polygon feature.
     wkt : str
@@ -111,9 +134,10 @@ def get_cell_weights(raster: xr.Dataset,
     xmax = raster.x[-1] + 0.001 # added buffer for skinny polygon
     ymin = raster.y[0]
     ymax = raster.y[-1] + 0.01
-    data_vars = list(raster.data_vars)
+    # hand exactextract a C-contiguous float32 array so it doesn't convert it again
+    values = np.ascontiguousarray(raster.values, dtype=np.float32)
     rastersource = NumPyRasterSource(
-        raster[data_vars[0]], srs_wkt=wkt, xmin=xmin, xmax=xmax, ymin=ymin, ymax=ymax
+        values, srs_wkt=wkt, xmin=xmin, xmax=xmax, ymin=ymin, ymax=ymax
     )
     output = exact_extract(
         rastersource,
@@ -125,28 +149,160 @@ def get_cell_weights(raster: xr.Dataset,
     return output.set_index("ID")
 
 
-def add_apcp_surface_to_dataset(dataset: xr.Dataset) -> xr.Dataset:
-    '''Convert precipitation value to correct units.'''
+def group_cell_weights(catchments: pd.DataFrame) -> Tuple[list, dict]:
+    '''
+    Collect the cell IDs and weights of every catchment into flat NumPy arrays
+    once, so that the per-timestep aggregation does not have to index the
+    DataFrame. The cells of the i-th catchment are
+    cell_ids[offsets[i]:offsets[i + 1]], in increasing order.
+
+    Parameters
+    ----------
+    catchments : pd.DataFrame
+        Output of get_all_cell_weights, indexed by catchment ID.
+
+    Returns
+    -------
+    list
+        Catchment IDs, in the order used by the arrays.
+    dict
+        {"offsets": int64 (n + 1,), "inv_weight_sums": float32 (n,),
+        "cell_ids": int32, "weights": float32}
+    '''
+    catchment_ids = []
+    cell_ids = []
+    weights = []
+    for catchment, rows in catchments.groupby(level=0, sort=False):
+        catchment_ids.append(catchment)
+        # exactextract returns one row per polygon, with arrays of all of its
+        # cells, a catchment can have more than one polygon
+        ids = np.concatenate([np.asarray(row_ids) for row_ids in rows["cell_id"]])
+        coverage = np.concatenate([np.asarray(row_coverage) for row_coverage in rows["coverage"]])
+        # sorted cell ids turn the gather into a near sequential walk of the raster
+        order = np.argsort(ids, kind="stable")
+        cell_ids.append(ids[order])
+        weights.append(coverage[order].astype(np.float32, copy=False))
+
+    offsets = np.zeros(len(catchment_ids) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(cells) for cells in cell_ids])
+    arrays = {
+        "offsets": offsets,
+        "inv_weight_sums": np.array([1 / w.sum(dtype=np.float64) for w in weights],
+                                    dtype=np.float32),
+        "cell_ids": np.concatenate(cell_ids).astype(np.int32, copy=False),
+        "weights": np.concatenate(weights),
+    }
+    return catchment_ids, arrays
+
+
+def create_shared_arrays(arrays: dict) -> Tuple[shared_memory.SharedMemory, dict]:
+    '''
+    Copy a few small arrays into a single SharedMemory block so that worker
+    processes can read them without them being pickled for every task.
+
+    Parameters
+    ----------
+    arrays : dict
+        {name: np.ndarray}. Arrays with the largest itemsize should come first
+        to keep every array aligned.
+
+    Returns
+    -------
+    shared_memory.SharedMemory
+        The block holding all of the arrays.
+    dict
+        {name: (byte offset, shape, dtype)}, used by attach_shared_arrays.
+    '''
+    layout = {}
+    size = 0
+    for name, array in arrays.items():
+        layout[name] = (size, array.shape, array.dtype.str)
+        size += array.nbytes
+    shm = shared_memory.SharedMemory(create=True, size=max(size, 1))
+    for name, array in arrays.items():
+        start, shape, dtype = layout[name]
+        np.ndarray(shape, dtype=dtype, buffer=shm.buf, offset=start)[:] = array
+    return shm, layout
+
+
+def attach_shared_arrays(shm: shared_memory.SharedMemory, layout: dict) -> dict:
+    '''Return zero-copy views of the arrays created by create_shared_arrays.'''
+    return {
+        name: np.ndarray(shape, dtype=dtype, buffer=shm.buf, offset=start)
+        for name, (start, shape, dtype) in layout.items()
+    }
+
+
+def release_shared_memory(shm: shared_memory.SharedMemory) -> None:
+    '''
+    Unlink and close a SharedMemory block created by this process. It is
+    unlinked first, so the block is never left behind in /dev/shm. Its memory
+    is freed once the last view of it is gone, even if close fails because an
+    array still uses it (e.g. one held by the traceback of an exception).
+    '''
+    shm.unlink()
+    try:
+        shm.close()
+    except BufferError:
+        logger.debug("Shared memory %s is still in use, it is closed with its views", shm.name)
+
+
+@contextmanager
+def unlink_on_exit(shm: shared_memory.SharedMemory):
+    '''Release a SharedMemory block at the end of a with block, also on errors.'''
+    try:
+        yield shm
+    finally:
+        release_shared_memory(shm)
+
+
+# cell weights attached once per worker process by init_worker
+_worker_shm = None
+_worker_cell_weights = {}
+
+
+def init_worker(shm_name: str, layout: dict, num_threads: int) -> None:
+    '''
+    Pool initializer, attach the shared cell weights in each worker and limit
+    the numba threads so the worker processes do not oversubscribe the cpus.
+    '''
+    global _worker_shm, _worker_cell_weights
+    set_num_threads(num_threads)
+    _worker_shm = shared_memory.SharedMemory(name=shm_name)
+    _worker_cell_weights = attach_shared_arrays(_worker_shm, layout)
+
+
+def get_precip_conversions(output_names: list) -> dict:
+    '''
+    Return the precipitation variable that is derived from the one in the
+    forcings, so that the forcings always have both units.
+
+    Parameters
+    ----------
+    output_names : list
+        Names of the variables written to the forcings file.
+
+    Returns
+    -------
+    dict
+        {derived variable name: (source variable name, factor, attributes)}.
+        The derived variable is the source variable multiplied by factor.
+    '''
     # precip_rate is mm/s
     # cfe says input atmosphere_water__liquid_equivalent_precipitation_rate is mm/h
     # nom says prcpnonc input is mm/s
     # technically should be kg/m^2/s at 1kg = 1l it equates to mm/s
     # nom says qinsur output is m/s, hopefully qinsur is converted to mm/h by ngen
-    dataset["APCP_surface"] = dataset["precip_rate"] * 3600
-    dataset["APCP_surface"].attrs["units"] = "mm h^-1" # ^-1 notation copied from source data
-    note = "This is just the precip_rate variable converted to mm/h by multiplying by 3600"
-    dataset["APCP_surface"].attrs["source_note"] = note
-    return dataset
-
-
-def add_precip_rate_to_dataset(dataset: xr.Dataset) -> xr.Dataset:
-    '''The inverse of add_apcp_surface_to_dataset.'''
-    dataset["precip_rate"] = dataset["APCP_surface"] / 3600
-    dataset["precip_rate"].attrs["units"] = "mm s^-1"
-    dataset["precip_rate"].attrs[
-        "source_note"
-    ] = "This is just the APCP_surface variable converted to mm/s by dividing by 3600"
-    return dataset
+    if "APCP_surface" in output_names:
+        note = "This is just the APCP_surface variable converted to mm/s by dividing by 3600"
+        return {"precip_rate": ("APCP_surface", 1 / 3600,
+                                {"units": "mm s^-1", "source_note": note})}
+    if "precip_rate" in output_names:
+        note = "This is just the precip_rate variable converted to mm/h by multiplying by 3600"
+        return {"APCP_surface": ("precip_rate", 3600,
+                                 # ^-1 notation copied from source data
+                                 {"units": "mm h^-1", "source_note": note})}
+    return {}
 
 
 def get_index_chunks(data: xr.DataArray) -> list[tuple[int, int]]:
@@ -174,13 +330,55 @@ def get_index_chunks(data: xr.DataArray) -> list[tuple[int, int]]:
     num_chunks = ceil(array_memory_usage / free_memory)
     # logging.debug("num_chunks: %s", num_chunks)
     max_index = data.shape[0]
-    stride = max_index // num_chunks
-    chunk_start = range(0, max_index, stride)
-    index_chunks = [(start, start + stride) for start in chunk_start]
+    # split into num_chunks nearly equal parts, the last end is always max_index
+    index_chunks = [
+        (int(part[0]), int(part[-1]) + 1)
+        for part in np.array_split(np.arange(max_index), min(num_chunks, max_index))
+        if len(part) > 0
+    ]
+    assert sum(end - start for start, end in index_chunks) == max_index
     # logging.debug("chunks: %s", index_chunks)
     return index_chunks
 
 
+def _l3_cache_size() -> int:
+    '''Size of the L3 cache in bytes, 32 MiB if the OS doesn't report it.'''
+    try:
+        size = os.sysconf("SC_LEVEL3_CACHE_SIZE")
+    except (AttributeError, ValueError, OSError):
+        size = 0
+    return size if size > 0 else 32 * 1024 * 1024
+
+
+L3_CACHE_BYTES = _l3_cache_size()
+
+# shortest block of timesteps, shorter blocks launch the kernel too often and
+# read only a few values of each cell's row
+MIN_BLOCK_LENGTH = 64
+
+
+def get_cache_block_length(n_cells: int, num_workers: int) -> int:
+    '''
+    Number of timesteps of the cells read by a worker that fit in its share of
+    the L3 cache, so that the rows of cells shared between catchments are
+    still cached when the next catchment reads them.
+
+    Parameters
+    ----------
+    n_cells : int
+        Number of distinct raster cells of the worker's catchments.
+    num_workers : int
+        Number of worker processes sharing the cache.
+
+    Returns
+    -------
+    int
+        Length of a block of timesteps, at least MIN_BLOCK_LENGTH.
+    '''
+    bytes_per_timestep = max(1, n_cells) * np.dtype(np.float32).itemsize
+    return max(MIN_BLOCK_LENGTH, (L3_CACHE_BYTES // num_workers) // bytes_per_timestep)
+
+
 def create_shared_memory(lazy_array: xr.Dataset) -> Tuple[
     shared_memory.SharedMemory,
     np.dtype,
@@ -201,82 +399,98 @@ def create_shared_memory(lazy_array: xr.Dataset) -> Tuple[
         A specific block of memory allocated by the OS of the size of 
         lazy_array.
     np.dtype.shape
-        A shape object with dimensions (# timesteps, # of raster cells) in
+        A shape object with dimensions (# of raster cells, # timesteps) in
         reference to lazy_array.
     np.dtype
         Data type of objects in lazy_array.
     '''
     logger.debug("Creating shared memory size %s Mb.", (lazy_array.nbytes/ 10**6))
-    shm = shared_memory.SharedMemory(create=True, size=lazy_array.nbytes)
-    shared_array = np.ndarray(lazy_array.shape, dtype=np.float32, buffer=shm.buf)
-    # if your data is not float32, xarray will do an automatic conversion here
-    # which consumes a lot more memory, forcings downloaded with this tool will work
-    for start, end in get_index_chunks(lazy_array):
-        # copy data from lazy to shared memory one chunk at a time
-        shared_array[start:end] = lazy_array[start:end]
-
-    time_shape = shared_array.shape[0]
-    shared_array = shared_array.reshape(time_shape, -1)
+    shm = shared_memory.SharedMemory(create=True, size=lazy_array.size * 4)
+    n_time = lazy_array.shape[0]
+    n_cells = lazy_array.size // n_time
+    # the block holds one row of timesteps per cell. It is filled through a
+    # strided view with the dimensions of lazy_array, so every cell's values
+    # are written in place without a transposed copy.
+    itemsize = np.dtype(np.float32).itemsize
+    strides = [itemsize * n_time]
+    for size in reversed(lazy_array.shape[2:]):
+        strides.insert(0, strides[0] * size)
+    shared_view = np.ndarray(lazy_array.shape, dtype=np.float32, buffer=shm.buf,
+                             strides=[itemsize] + strides)
+    # let dask read the data one chunk at a time and write each chunk straight
+    # into shared memory, so no full size temporary is created. Data that is not
+    # float32 is converted chunk by chunk on the way in.
+    if lazy_array.chunks is None:
+        lazy_array = lazy_array.chunk({"time": "auto"})
+    # the threaded scheduler is needed, a distributed worker would write into
+    # a pickled copy of the target instead of the shared memory
+    try:
+        dask.array.store(lazy_array.data.astype(np.float32), shared_view,
+                         lock=False, scheduler="threads")
+    except BaseException:
+        # don't leave the block behind if the data can't be read
+        release_shared_memory(shm)
+        raise
+    del shared_view
 
-    return shm, shared_array.shape, shared_array.dtype
+    return shm, (n_cells, n_time), np.dtype(np.float32)
 
 
-def process_chunk_shared(variable: str,
-                         times: np.ndarray,
-                         shm_name: str,
+def process_chunk_shared(shm_name: str,
                          shape: np.dtype.shape,
                          dtype: np.dtype,
-                         chunk: gpd.GeoDataFrame) -> xr.DataArray:
-    '''  
-    Process the gridded forcings chunk loaded into a SharedMemory block. 
+                         output_shm_name: str,
+                         block_length: int,
+                         chunk: Tuple[int, int]) -> None:
+    '''
+    Process the gridded forcings chunk loaded into a SharedMemory block and
+    write the averages of a subset of the catchments into the shared output.
 
     Parameters
     ----------
-    variable : str
-        Name of forcing variable to be processed.
-    times : np.ndarray
-        Timesteps in gridded forcings chunk.
     shm_name : str
         Unique name that identifies the SharedMemory block.
     shape : np.dtype.shape
-        A shape object with dimensions (# timesteps, # of raster cells) in
+        A shape object with dimensions (# of raster cells, # timesteps) in
         reference to the gridded forcings chunk.
     dtype : np.dtype
         Data type of objects in the gridded forcings chunk.
-    chunk : gpd.GeoDataFrame
-        A chunk of gridded forcings data.
-
-    Returns
-    -------
-    xr.DataArray
-        Averaged forcings data for each timestep for each catchment.
+    output_shm_name : str
+        Unique name of the SharedMemory block holding the float32 output array
+        of dimensions (# catchments, # timesteps).
+    block_length : int
+        Number of timesteps processed at a time, from get_cache_block_length.
+    chunk : Tuple[int, int]
+        Start and stop positions of a subset of the catchments in the shared
+        cell weight arrays. The same rows of the output are written.
     '''
+    start, stop = chunk
+    n_catchments = _worker_cell_weights["inv_weight_sums"].shape[0]
     existing_shm = shared_memory.SharedMemory(name=shm_name)
+    output_shm = shared_memory.SharedMemory(name=output_shm_name)
     raster = np.ndarray(shape, dtype=dtype, buffer=existing_shm.buf)
-    results = []
-
-    for catchment in chunk.index.unique():
-        cell_ids = chunk.loc[catchment]["cell_id"]
-        weights = chunk.loc[catchment]["coverage"]
-        mean_at_timesteps = weighted_sum_of_cells(raster, cell_ids, weights)
-        temp_da = xr.DataArray(
-            mean_at_timesteps,
-            dims=["time"],
-            coords={"time": times},
-            name=f"{variable}_{catchment}",
-        )
-        temp_da = temp_da.assign_coords(catchment=catchment)
-        results.append(temp_da)
+    assert raster.dtype == np.float32, "raster has to be float32"
+    output = np.ndarray((n_catchments, shape[1]), dtype=np.float32, buffer=output_shm.buf)
+    # work through the chunk in blocks of timesteps that stay in the cache
+    for block_start in range(0, shape[1], block_length):
+        block = slice(block_start, block_start + block_length)
+        weighted_sum_of_cells(raster[:, block],
+                              _worker_cell_weights["offsets"][start:stop + 1],
+                              _worker_cell_weights["cell_ids"],
+                              _worker_cell_weights["weights"],
+                              _worker_cell_weights["inv_weight_sums"][start:stop],
+                              output[start:stop, block])
+    del raster, output
     existing_shm.close()
-    return xr.concat(results, dim="catchment")
+    output_shm.close()
 
 
-def get_cell_weights_parallel(gdf: gpd.GeoDataFrame,
-                              input_forcings: xr.Dataset,
-                              num_partitions: int) -> pd.DataFrame:
+def get_all_cell_weights(gdf: gpd.GeoDataFrame,
+                         input_forcings: xr.Dataset) -> pd.DataFrame:
     '''
-    Execute get_cell_weights with multiprocessing, with chunking for the passed
-    GeoDataFrame to conserve memory usage.
+    Execute get_cell_weights for every polygon in the passed GeoDataFrame in a
+    single exactextract call, which shares the rasterization state across all
+    of the polygons instead of redoing it in a pool of processes.
 
     Parameters
     ----------
@@ -284,8 +498,6 @@ def get_cell_weights_parallel(gdf: gpd.GeoDataFrame,
         A GeoDataFrame with a polygon feature.
     input_forcings : xr.Dataset
         A gridded forcings file.
-    num_partitions : int
-        Number of chunks to split gdf into.
 
     Returns
     -------
@@ -293,14 +505,21 @@ def get_cell_weights_parallel(gdf: gpd.GeoDataFrame,
         DataFrame indexed by divide_id that contains information about coverage
         for each raster cell and each timestep in gridded forcing file.
     '''
-
-    gdf_chunks = np.array_split(gdf, num_partitions)
     wkt = gdf.crs.to_wkt()
-    one_timestep = input_forcings.isel(time=0).compute()
-    with multiprocessing.Pool() as pool:
-        args = [(one_timestep, gdf_chunk, wkt) for gdf_chunk in gdf_chunks]
-        catchments = pool.starmap(get_cell_weights, args)
-    return pd.concat(catchments)
+    # the weights only depend on the grid, so load a single variable, not the
+    # whole first timestep
+    first_var = list(input_forcings.data_vars)[0]
+    one_timestep = input_forcings[first_var].isel(time=0).compute()
+    catchments = get_cell_weights(one_timestep, gdf, wkt)
+    # exactextract returns arrays of int64 cell ids and float64 coverage for
+    # every polygon, keep the weights in single precision so the products with
+    # the float32 raster stay float32. The columns hold one array per row, so
+    # each array is cast.
+    catchments["cell_id"] = catchments["cell_id"].map(lambda ids: np.asarray(ids, np.int32))
+    catchments["coverage"] = catchments["coverage"].map(
+        lambda coverage: np.asarray(coverage, np.float32))
+    return catchments
+
 
 def get_units(dataset: xr.Dataset) -> dict:
     '''
@@ -347,7 +566,7 @@ def compute_zonal_stats(
     if num_partitions > len(gdf):
         num_partitions = len(gdf)
 
-    catchments = get_cell_weights_parallel(gdf, merged_data, num_partitions)
+    catchments = get_all_cell_weights(gdf, merged_data)
     units = get_units(merged_data)
 
     variables = {
@@ -361,7 +580,26 @@ def compute_zonal_stats(
                 "V2D": "VGRD_10maboveground",
             }
 
-    cat_chunks = np.array_split(catchments, num_partitions)
+    output_names = {var: variables.get(var, var) for var in merged_data.data_vars}
+    precip_conversions = get_precip_conversions(list(output_names.values()))
+
+    # the cell weights live in shared memory, only the position range of each
+    # worker's catchments is sent to the workers
+    catchment_ids, cell_weights = group_cell_weights(catchments)
+    cat_chunks = [
+        (int(part[0]), int(part[-1]) + 1)
+        for part in np.array_split(np.arange(len(catchment_ids)), num_partitions)
+        if len(part) > 0
+    ]
+    # each worker only reads the cells of its own catchments, the blocks of
+    # timesteps are sized to those cells
+    offsets = cell_weights["offsets"]
+    block_lengths = [
+        get_cache_block_length(
+            np.unique(cell_weights["cell_ids"][offsets[start]:offsets[stop]]).size,
+            num_partitions)
+        for start, stop in cat_chunks
+    ]
 
     progress = Progress(
         TextColumn("[progress.description]{task.description}"),
@@ -380,80 +618,78 @@ def compute_zonal_stats(
         "[cyan]Processing variables...", total=len(variables), elapsed=0
     )
     progress.start()
-    try:
-        client = Client.current()
-    except ValueError:
-        cluster = LocalCluster()
-        client = Client(cluster)
-    for variable in list(merged_data.data_vars):
-        progress.update(variable_task, advance=1)
-        progress.update(variable_task, description=f"Processing {variable}")
-
-        if variable not in merged_data.data_vars:
-            logger.warning("Variable %s not in forcings, skipping", variable)
-            continue
-
-        # to make sure this fits in memory, we need to chunk the data
-        time_chunks = get_index_chunks(merged_data[variable])
-        chunk_task = progress.add_task("[purple] processing chunks", total=len(time_chunks))
-        for i, times in enumerate(time_chunks):
-            progress.update(chunk_task, advance=1)
-            start, end = times
-            # select the chunk of time we want to process
-            data_chunk = merged_data[variable].isel(time=slice(start,end))
-            # put it in shared memory
-            shm, shape, dtype = create_shared_memory(data_chunk)
-            times = data_chunk.time.values
-            # create a partial function to pass to the multiprocessing pool
-            partial_process_chunk = partial(process_chunk_shared,
-                                            variable,
-                                            times,
-                                            shm.name,
-                                            shape,
-                                            dtype)
-
-            logger.debug("Processing variable: %s", variable)
-            # process the chunks of catchments in parallel
-            with multiprocessing.Pool(num_partitions) as pool:
-                variable_data = pool.map(partial_process_chunk, cat_chunks)
-            del partial_process_chunk
-            # clean up the shared memory
-            logger.debug("Shared memory closed and unlinked, size %s Mb", (shm.size / 10**6))
-            shm.close()
-            shm.unlink()
-
-            logger.debug("Processed variable: %s", variable)
-            concatenated_da = xr.concat(variable_data, dim="catchment")
-            # delete the data to free up memory
-            del variable_data
-            logger.debug("Concatenated variable: %s", variable)
-            # write this to disk now to save memory
-            # xarray will monitor memory usage, but it doesn't account
-            # for the shared memory used to store the raster
-            # This reduces memory usage by about 60%
-            concatenated_da.to_dataset(name=variable).to_netcdf(
-                forcings_dir / "temp" / f"{variable}_timechunk_{i}.nc"
-            )
-
-        datasets = [
-            xr.open_dataset(forcings_dir / "temp" / f"{variable}_timechunk_{i}.nc", cache=False)
-            for i in range(len(time_chunks))
-        ]
-
-        # result = xr.concat(datasets, dim="time")
-
-        xr.concat(datasets, dim="time").to_netcdf(forcings_dir / "temp" / f"{variable}.nc")
-        # result.to_netcdf(forcings_dir / "temp" / f"{variable}.nc")
-
-        # close the datasets
-        # result.close()
-        _ = [dataset.close() for dataset in datasets]
-        del datasets
-        for file in forcings_dir.glob("temp/*_timechunk_*.nc"):
-            file.unlink()
-        progress.remove_task(chunk_task)
-
-            
+    # start the worker pool once and keep it for every variable and time chunk,
+    # forkserver avoids forking a copy of the parent after xarray/dask are loaded
+    context = multiprocessing.get_context("forkserver")
+    # every time chunk is written straight into its slice of the final file,
+    # nothing is written to temporary files and merged afterwards
+    output_nc = create_output_file(forcings_dir / "forcings.nc",
+                                   catchment_ids,
+                                   merged_data.time.values,
+                                   output_names,
+                                   units)
+    weights_shm, weights_layout = create_shared_arrays(cell_weights)
+    # the shared memory is unlinked even if a worker or a write fails
+    with unlink_on_exit(weights_shm), output_nc, context.Pool(
+            num_partitions,
+            initializer=init_worker,
+            initargs=(weights_shm.name,
+                      weights_layout,
+                      max(1, multiprocessing.cpu_count() // num_partitions))) as pool:
+        for variable in list(merged_data.data_vars):
+            progress.update(variable_task, advance=1)
+            progress.update(variable_task, description=f"Processing {variable}")
+
+            if variable not in merged_data.data_vars:
+                logger.warning("Variable %s not in forcings, skipping", variable)
+                continue
+
+            # to make sure this fits in memory, we need to chunk the data
+            time_chunks = get_index_chunks(merged_data[variable])
+            chunk_task = progress.add_task("[purple] processing chunks", total=len(time_chunks))
+            for times in time_chunks:
+                progress.update(chunk_task, advance=1)
+                start, end = times
+                # select the chunk of time we want to process
+                data_chunk = merged_data[variable].isel(time=slice(start,end))
+                times = data_chunk.time.values
+                # the workers write their catchments' rows of this array directly,
+                # so no per-worker results have to be pickled and concatenated
+                output_shm = shared_memory.SharedMemory(create=True,
+                                                        size=len(catchment_ids) * len(times) * 4)
+                with unlink_on_exit(output_shm):
+                    # put it in shared memory
+                    shm, shape, dtype = create_shared_memory(data_chunk)
+                    # the raster is released as soon as the workers are done with it
+                    with unlink_on_exit(shm):
+                        # create a partial function to pass to the multiprocessing pool
+                        partial_process_chunk = partial(process_chunk_shared,
+                                                        shm.name,
+                                                        shape,
+                                                        dtype,
+                                                        output_shm.name)
+
+                        logger.debug("Processing variable: %s", variable)
+                        # process the chunks of catchments in parallel
+                        pool.starmap(partial_process_chunk, zip(block_lengths, cat_chunks))
+                        del partial_process_chunk
+                        logger.debug("Shared memory closed and unlinked, size %s Mb",
+                                     (shm.size / 10**6))
+
+                    logger.debug("Processed variable: %s", variable)
+                    output = np.ndarray((len(catchment_ids), len(times)), dtype=np.float32,
+                                        buffer=output_shm.buf)
+                    # write this to disk now to save memory
+                    name = output_names[variable]
+                    write_forcing_chunk(output_nc, name, output, start, end)
+                    for derived, (source, factor, _) in precip_conversions.items():
+                        if source == name:
+                            write_forcing_chunk(output_nc, derived,
+                                                output * np.float32(factor), start, end)
+                    del output
+
+            progress.remove_task(chunk_task)
+
     progress.update(
         variable_task,
         description=f"Forcings processed in {time.perf_counter() - timer:2f} seconds",
@@ -462,90 +698,129 @@ def compute_zonal_stats(
     info = f"Zonal stats computed in {time.time() - timer_start:2f} seconds"
     logger.info("Forcing generation complete!")
     logger.info(info)
-    write_outputs(forcings_dir, variables, units)
 
 
-def write_outputs(forcings_dir: Path,
-                  variables: dict,
-                  units: dict) -> None:
-    '''  
-    Write outputs to disk in the form of a NetCDF file, using dask clusters to
-    facilitate parallel computing.
+def create_output_file(path: Path,
+                       catchment_ids: list,
+                       times: np.ndarray,
+                       output_names: dict,
+                       units: dict) -> netCDF4.Dataset:
+    '''
+    Create the forcings NetCDF file with every variable declared, so that the
+    zonal stats can be written into it one chunk at a time.
 
     Parameters
     ----------
-    forcings_dir : Path
-        Path to directory where outputs are to be stored.
-    variables : dict
-        Preset dictionary where the keys are forcing variable names and the 
-        values are units.
+    path : Path
+        Path of the NetCDF file.
+    catchment_ids : list
+        Catchment ids, in the order of the rows of the forcing variables.
+    times : np.ndarray
+        Timesteps of the forcing variables.
+    output_names : dict
+        {gridded forcing variable name: name in the forcings file}.
     units : dict
-        Dictionary where the keys are forcing variable names and the values are 
-        units. Differs from variables, as this dictionary depends on the gridded
-        forcing dataset.
-    '''
-
-    # start a dask cluster if there isn't one already running
-    try:
-        client = Client.current()
-    except ValueError:
-        cluster = LocalCluster()
-        client = Client(cluster)
-    temp_forcings_dir = forcings_dir / "temp"
-    # Combine all variables into a single dataset using dask
-    results = [xr.open_dataset(file, chunks="auto") for file in temp_forcings_dir.glob("*.nc")]
-    final_ds = xr.merge(results)
-    for var in final_ds.data_vars:
-        if var in units:
-            final_ds[var].attrs["units"] = units[var]
-        else:
-            logger.warning("Variable %s has no units", var)
-
-    rename_dict = {}
-    for key, value in variables.items():
-        if key in final_ds:
-            rename_dict[key] = value
+        Dictionary where the keys are forcing variable names and the values are
+        units, from get_units.
 
-    final_ds = final_ds.rename_vars(rename_dict)
-    if "APCP_surface" in final_ds.data_vars:
-        final_ds = add_precip_rate_to_dataset(final_ds)
-    elif "precip_rate" in final_ds.data_vars:
-        final_ds = add_apcp_surface_to_dataset(final_ds)
-
-    # this step halves the storage size of the forcings
-    for var in final_ds.data_vars:
-        final_ds[var] = final_ds[var].astype(np.float32)
-
-    logger.info("Saving to disk")
+    Returns
+    -------
+    netCDF4.Dataset
+        The open forcings file, the forcing variables are still empty.
+    '''
+    n_catchments = len(catchment_ids)
     # The format for the netcdf is to support a legacy format
     # which is why it's a little "unorthodox"
     # There are no coordinates, just dimensions, catchment ids are stored in a 1d data var
     # and time is stored in a 2d data var with the same time array for every catchment
     # time is stored as unix timestamps, units have to be set
+    dataset = netCDF4.Dataset(path, "w", format="NETCDF4")
+    dataset.createDimension("catchment_id", n_catchments)
+    dataset.createDimension("time", len(times))
+    dataset.createDimension("catchment-id", n_catchments)
+    # chunk every variable along time with light compression, the default zlib
+    # level is the bottleneck of this write
+    chunksizes = (n_catchments, min(len(times), OUTPUT_TIME_CHUNK))
+
+    for var, name in output_names.items():
+        nc_var = create_forcing_variable(dataset, name, chunksizes)
+        if var in units:
+            nc_var.units = units[var]
+        else:
+            logger.warning("Variable %s has no units", var)
+    for name, (_, _, attrs) in get_precip_conversions(list(output_names.values())).items():
+        nc_var = create_forcing_variable(dataset, name, chunksizes)
+        nc_var.setncatts(attrs)
+
     # add the catchment ids as a 1d data var
-    final_ds["ids"] = final_ds["catchment"].astype(str)
+    dataset.createVariable("ids", str, ("catchment_id",))
+    dataset["ids"][:] = np.array(catchment_ids, dtype=str).astype(object)
+
     # time needs to be a 2d array of the same time array as unix timestamps for every catchment
-    with warnings.catch_warnings():
-        warnings.simplefilter("ignore")
-        time_array = (
-            final_ds.time.astype("datetime64[s]").astype(np.int64).values // 10**9
-        )  ## convert from ns to s
+    time_array = times.astype("datetime64[s]").astype(np.int64) ## convert from ns to s
     time_array = time_array.astype(np.int32) ## convert to int32 to save space
-    final_ds = final_ds.drop_vars(["catchment", "time"]) ## drop the original time/catchment vars
-    final_ds = final_ds.rename_dims({"catchment": "catchment_id"}) # rename the catchment dimension
     # add the time as a 2d data var, yes this is wasting disk space.
-    final_ds["Time"] = (("catchment-id", "time"), [time_array for _ in range(len(final_ds["ids"]))])
+    time_var = dataset.createVariable("Time", "i4", ("catchment-id", "time"),
+                                      zlib=True, complevel=1, chunksizes=chunksizes)
     # set the time unit
-    final_ds["Time"].attrs["units"] = "s"
-    final_ds["Time"].attrs["epoch_start"] = "01/01/1970 00:00:00" # not needed but suppresses
-                                                                  # the ngen warning
-
-    final_ds.to_netcdf(forcings_dir / "forcings.nc", engine="netcdf4")
-    # close the datasets
-    _ = [result.close() for result in results]
-    final_ds.close()
-
-    # clean up the temp files
-    for file in temp_forcings_dir.glob("*.*"):
-        file.unlink()
-    temp_forcings_dir.rmdir()
\ No newline at end of file
+    time_var.units = "s"
+    time_var.epoch_start = "01/01/1970 00:00:00" # not needed but suppresses
+                                                 # the ngen warning
+    # broadcast_to is a zero-copy view, only one chunk of the tile is expanded
+    # at a time
+    for start in range(0, len(times), OUTPUT_TIME_CHUNK):
+        block = time_array[start:start + OUTPUT_TIME_CHUNK]
+        time_var[:, start:start + block.size] = np.broadcast_to(block,
+                                                               (n_catchments, block.size))
+    return dataset
+
+
+def create_forcing_variable(dataset: netCDF4.Dataset,
+                            name: str,
+                            chunksizes: Tuple[int, int]) -> netCDF4.Variable:
+    '''
+    Declare a (catchment_id, time) forcing variable in the forcings file.
+    Variables with a packing range are stored as int16 with a scale_factor and
+    add_offset, which halves the file size, the others are stored as float32.
+    '''
+    packing = get_packing(name)
+    if packing is None:
+        return dataset.createVariable(name, "f4", ("catchment_id", "time"),
+                                      zlib=True, complevel=1,
+                                      chunksizes=chunksizes, fill_value=np.nan)
+    nc_var = dataset.createVariable(name, "i2", ("catchment_id", "time"),
+                                    zlib=True, complevel=1, chunksizes=chunksizes,
+                                    fill_value=packing["_FillValue"])
+    nc_var.scale_factor = packing["scale_factor"]
+    nc_var.add_offset = packing["add_offset"]
+    # the values are packed by write_forcing_chunk, so they are written as is
+    nc_var.set_auto_maskandscale(False)
+    return nc_var
+
+
+def write_forcing_chunk(dataset: netCDF4.Dataset,
+                        name: str,
+                        values: np.ndarray,
+                        start: int,
+                        end: int) -> None:
+    '''
+    Write the float32 averages of a chunk of timesteps into a forcing variable
+    of the forcings file, packing them if the variable is stored as int16.
+
+    Parameters
+    ----------
+    dataset : netCDF4.Dataset
+        The forcings file, from create_output_file.
+    name : str
+        Name of the forcing variable in the forcings file.
+    values : np.ndarray
+        Array of dimensions (# catchments, end - start).
+    start : int
+        Index of the first timestep of the chunk.
+    end : int
+        Index after the last timestep of the chunk.
+    '''
+    packing = get_packing(name)
+    if packing is not None:
+        values = pack(clip_to_packing_range(values, name), packing)
+    dataset[name][:, start:end] = values
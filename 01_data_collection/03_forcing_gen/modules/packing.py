@@ -0,0 +1,107 @@
+"""This module packs forcing variables into int16 with a scale_factor and
+add_offset (the NetCDF packed-integer convention). Every variable has a fixed
+physical range so that the packing is known before any data is written, and
+values outside of the range are clipped to it.
+"""
+
+from typing import Optional
+import numpy as np
+
+# value reserved for missing data, the packed values are -32767 to 32767
+PACKED_FILL_VALUE = np.int16(-32768)
+PACKED_STEPS = 65534
+
+# {variable name: (minimum, maximum)} in the units of the source data, both the
+# AORC and the retrospective (NWM) names are listed. Pressure is left out, its
+# range would only leave a resolution of about 1 Pa.
+PACKED_RANGES = {
+    # K
+    "TMP_2maboveground": (180.0, 340.0),
+    "T2D": (180.0, 340.0),
+    # kg kg^-1
+    "SPFH_2maboveground": (0.0, 0.04),
+    "Q2D": (0.0, 0.04),
+    # W m^-2
+    "DLWRF_surface": (0.0, 700.0),
+    "LWDOWN": (0.0, 700.0),
+    "DSWRF_surface": (0.0, 1500.0),
+    "SWDOWN": (0.0, 1500.0),
+    # m s^-1
+    "UGRD_10maboveground": (-75.0, 75.0),
+    "U2D": (-75.0, 75.0),
+    "VGRD_10maboveground": (-75.0, 75.0),
+    "V2D": (-75.0, 75.0),
+    # mm h^-1, hourly accumulation for AORC
+    "APCP_surface": (0.0, 250.0),
+    # mm s^-1
+    "precip_rate": (0.0, 250.0 / 3600),
+    "RAINRATE": (0.0, 250.0 / 3600),
+}
+
+
+def get_packing(name: str) -> Optional[dict]:
+    '''
+    Return the int16 packing of a forcing variable.
+
+    Parameters
+    ----------
+    name : str
+        Name of the forcing variable.
+
+    Returns
+    -------
+    Optional[dict]
+        Encoding with the dtype, scale_factor, add_offset and _FillValue of the
+        packed variable, None if the variable is kept as float32.
+    '''
+    if name not in PACKED_RANGES:
+        return None
+    vmin, vmax = PACKED_RANGES[name]
+    # the attributes are float32 so readers unpack into float32, the offset is
+    # computed in float32 too so that vmin unpacks to exactly vmin when it is 0
+    scale_factor = np.float32((vmax - vmin) / PACKED_STEPS)
+    add_offset = np.float32(vmin) + scale_factor * np.float32(PACKED_STEPS // 2)
+    return {
+        "dtype": "int16",
+        "scale_factor": scale_factor,
+        "add_offset": add_offset,
+        "_FillValue": PACKED_FILL_VALUE,
+    }
+
+
+def clip_to_packing_range(data, name: str):
+    '''
+    Clip a numpy array or an xarray object to the packing range of a variable,
+    packing a value outside of the range would overflow int16. Missing values
+    are kept.
+    '''
+    if name not in PACKED_RANGES:
+        return data
+    vmin, vmax = PACKED_RANGES[name]
+    return data.clip(vmin, vmax)
+
+
+def pack(values: np.ndarray, packing: dict) -> np.ndarray:
+    '''
+    Pack float values into int16.
+
+    Parameters
+    ----------
+    values : np.ndarray
+        Float values of a forcing variable, already clipped to its range.
+    packing : dict
+        Packing of the variable, from get_packing.
+
+    Returns
+    -------
+    np.ndarray
+        int16 array, missing values are set to the fill value.
+    '''
+    packed = np.asarray(values, dtype=np.float32) - packing["add_offset"]
+    packed /= packing["scale_factor"]
+    np.rint(packed, out=packed)
+    missing = np.isnan(packed)
+    packed[missing] = 0
+    packed = packed.astype(np.int16)
+    packed[missing] = packing["_FillValue"]
+    return packed
@@ -44,7 +44,9 @@ class S3ParallelFileSystem(S3FileSystem):
             # Fall back to single request if HEAD fails
             return await self._download_chunk(bucket, key, {}, version_kw)
 
-        chunk_size = 5 * 1024 * 1024  # 1MB chunks
+        # large objects are downloaded in ranges of one block, the loaders set
+        # it to 8MB
+        chunk_size = self.default_block_size
         if obj_size <= chunk_size:
             return await self._download_chunk(bucket, key, {}, version_kw)
 
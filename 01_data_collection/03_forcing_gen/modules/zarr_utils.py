@@ -1,6 +1,6 @@
 """Load and process zarr datasets from S3.
 This module provides functions to load zarr datasets from S3, clip them to a specified
-geographical bounding box, and cache the results in a netCDF file.
+geographical bounding box, and cache the results in a zarr store.
 It also includes functions to validate the time range of the datasets and
 compute the store for the datasets.
 
@@ -10,66 +10,193 @@ https://github.com/CIROH-UA/NGIAB_data_preprocess
 Adapted by Quinn Lee (GitHub @quinnylee)
 """
 
+import atexit
 import logging
-import os
+import shutil
+from math import ceil
 from pathlib import Path
 from typing import Tuple
-import sys
 import geopandas as gpd
 import numpy as np
+import pandas as pd
 import s3fs
 import xarray as xr
+import zarr
+import dask
+import dask.array
 from dask.distributed import Client, LocalCluster, progress
+from numcodecs import Blosc
 import rich
 
-sys.path.append("./modules")
-from s3fs_utils import S3ParallelFileSystem
+from .s3fs_utils import S3ParallelFileSystem
+from .packing import clip_to_packing_range, get_packing
 
 logger = logging.getLogger(__name__)
 
+# names of the forcing variables (named after the retrospective zarr stores)
+# in the AORC zarr stores
+AORC_VARIABLES = {
+    "lwdown": "DLWRF_surface",
+    "precip": "APCP_surface",
+    "psfc": "PRES_surface",
+    "q2d": "SPFH_2maboveground",
+    "swdown": "DSWRF_surface",
+    "t2d": "TMP_2maboveground",
+    "u2d": "UGRD_10maboveground",
+    "v2d": "VGRD_10maboveground",
+}
+
+# the zarr chunks are read whole and split into parallel ranges of one block,
+# 8MB is in the range that gets the best throughput per S3 request. The default
+# cache is readahead which is detrimental to performance in this case.
+# botocore keeps at most 10 connections open by default, fewer than the
+# concurrent range requests of S3ParallelFileSystem, the requests past the pool
+# size would wait for a connection.
+S3_FILESYSTEM_KWARGS = {
+    "default_cache_type": "none",
+    "default_block_size": 2**23,
+    "config_kwargs": {"max_pool_connections": 64},
+}
+
+# chunks of the variables in the cached zarr store, {dimension: length}
+CACHE_CHUNKS = {"time": 24 * 30, "y": 256, "x": 256}
+
+# compressor of the variables in the cached zarr store. The forcing fields are
+# smooth in space and time, so the bits of neighbouring values are mostly the
+# same and bit shuffling before zstd compresses them far better than the
+# default lz4 with byte shuffling.
+CACHE_COMPRESSOR = Blosc(cname="zstd", clevel=3, shuffle=Blosc.BITSHUFFLE)
+
+# timesteps that compute_store downloads and writes at once, about a year
+TIMESTEPS_PER_WRITE = 24 * 365
+
+# variable of a shared cache that flags the blocks of the grid that are
+# downloaded, see create_shared_store
+DOWNLOADED_BLOCKS = "downloaded_blocks"
+
+# dask client used by this module, from _get_client
+_CLIENT = None
+
+# datasets opened in this process, {tuple of store urls: xr.Dataset}
+_DATASET_CACHE = {}
+
+
+def _get_client() -> Client:
+    '''
+    Return the dask client of this module. The running client is reused, if
+    there isn't one a LocalCluster is started once and closed at exit.
+    '''
+    global _CLIENT
+    if _CLIENT is None or _CLIENT.status in ("closing", "closed"):
+        try:
+            _CLIENT = Client.current()
+        except ValueError:
+            cluster = LocalCluster()
+            _CLIENT = Client(cluster)
+            atexit.register(_close_client, _CLIENT)
+    return _CLIENT
+
+
+def _close_client(client: Client) -> None:
+    '''Close a client started by _get_client and its cluster.'''
+    cluster = client.cluster
+    client.close()
+    if cluster is not None:
+        cluster.close()
+
+
+def open_zarr_stores(urls: list[str], fs: s3fs.S3FileSystem, **kwargs) -> xr.Dataset:
+    '''
+    Open zarr stores on S3 as a single lazy dataset. The consolidated metadata
+    of each store is read in one request, stores without it are opened with
+    the metadata of every array instead. The dataset is reused for later calls
+    with the same urls in this process.
+
+    Parameters
+    ----------
+    urls : list[str]
+        S3 urls of the zarr stores.
+    fs : s3fs.S3FileSystem
+        File system used to read the stores.
+    **kwargs
+        Passed to xr.open_mfdataset, to choose how the stores are combined.
+
+    Returns
+    -------
+    xr.Dataset
+        The combined lazy dataset.
+    '''
+    key = tuple(urls)
+    if key in _DATASET_CACHE:
+        logger.debug("Reusing opened zarr stores")
+        return _DATASET_CACHE[key]
+    filestores = [s3fs.S3Map(url, s3=fs) for url in urls]
+    # the cache option here just holds accessed data in memory to prevent s3 being queried
+    # multiple times
+    # most of the data is read once and written to disk but some of the coordinate data is
+    # read multiple times
+    try:
+        dataset = xr.open_mfdataset(filestores, parallel=True, engine="zarr", cache=True,
+                                    backend_kwargs={"consolidated": True}, **kwargs)
+    except (KeyError, FileNotFoundError):
+        logger.debug("Zarr stores have no consolidated metadata")
+        dataset = xr.open_mfdataset(filestores, parallel=True, engine="zarr", cache=True,
+                                    backend_kwargs={"consolidated": False}, **kwargs)
+    _DATASET_CACHE[key] = dataset
+    return dataset
+
+
 def load_zarr_datasets(forcing_vars: list[str] = None) -> xr.Dataset:
     """Load zarr datasets from S3 within the specified time range."""
-    # if a LocalCluster is not already running, start one
     if not forcing_vars:
         forcing_vars = ["lwdown", "precip", "psfc", "q2d", "swdown", "t2d", "u2d", "v2d"]
-    try:
-        client = Client.current()
-    except ValueError:
-        cluster = LocalCluster()
-        client = Client(cluster)
+    # if a LocalCluster is not already running, start one
+    _get_client()
     s3_urls = [
         f"s3://noaa-nwm-retrospective-3-0-pds/CONUS/zarr/forcing/{var}.zarr"
         for var in forcing_vars
     ]
-    # default cache is readahead which is detrimental to performance in this case
-    fs = S3ParallelFileSystem(anon=True, default_cache_type="none")  # default_block_size
-    s3_stores = [s3fs.S3Map(url, s3=fs) for url in s3_urls]
-    # the cache option here just holds accessed data in memory to prevent s3 being queried
-    # multiple times
-    # most of the data is read once and written to disk but some of the coordinate data is
-    # read multiple times
-    dataset = xr.open_mfdataset(s3_stores, parallel=True, engine="zarr", cache=True)
+    fs = S3ParallelFileSystem(anon=True, **S3_FILESYSTEM_KWARGS)
+    # every store holds one variable on the same grid and times, so they are
+    # merged (concat_dim=None) keeping the coordinates of the first store
+    # instead of sorting and comparing the coordinates of every store
+    dataset = open_zarr_stores(s3_urls, fs,
+                               combine="nested",
+                               concat_dim=None,
+                               data_vars="minimal",
+                               coords="minimal",
+                               compat="override",
+                               join="override")
+    # crs is a data variable in these stores, keep it with the coordinates so
+    # every data variable is a forcing variable
+    if "crs" in dataset.data_vars:
+        dataset = dataset.set_coords("crs")
     return dataset
 
 def load_aorc_zarr_datasets(start_year: int = 1979, end_year: int = 2024) -> xr.Dataset:
     """Load the aorc zarr dataset from S3."""
-    try:
-        client = Client.current()
-    except ValueError:
-        cluster = LocalCluster()
-        client = Client(cluster)
+    # if a LocalCluster is not already running, start one
+    _get_client()
     info = f"Loading AORC zarr datasets from {start_year} to {end_year}"
     logger.info(info)
     estimated_time_s = ((end_year - start_year) * 2.5) + 3.5
     # from testing, it's about 2.1s per year + 3.5s overhead
     logger.info("This should take roughly %s seconds", estimated_time_s)
-    fs = S3ParallelFileSystem(anon=True, default_cache_type="none")
+    fs = S3ParallelFileSystem(anon=True, **S3_FILESYSTEM_KWARGS)
     s3_url = "s3://noaa-nws-aorc-v1-1-1km/"
     urls = [f"{s3_url}{i}.zarr" for i in range(start_year, end_year)]
-    filestores = [s3fs.S3Map(url, s3=fs) for url in urls]
     timer = rich.progress.Progress()
     timer.start()
-    dataset = xr.open_mfdataset(filestores, parallel=True, engine="zarr", cache=True)
+    # the stores are opened in parallel on the dask cluster. Every year has the
+    # same grid and variables, so they are concatenated in order along time
+    # without comparing the coordinates and variables of every store
+    dataset = open_zarr_stores(urls, fs,
+                               combine="nested",
+                               concat_dim="time",
+                               data_vars="minimal",
+                               coords="minimal",
+                               compat="override",
+                               join="override")
     # add dataset.crs and dataset.crs.esri_pe_string
     dataset = dataset.assign_coords(crs=1)
     dataset.crs.attrs = {"esri_pe_string": "+proj=longlat +datum=WGS84 +no_defs"}
@@ -101,17 +228,18 @@ def validate_time_range(dataset: xr.Dataset, start_time: str, end_time: str) ->
     str
         end_time, or if not available, latest available timestep in dataset.
     '''
-    end_time_in_dataset = dataset.time.isel(time=-1).values
-    start_time_in_dataset = dataset.time.isel(time=0).values
-    if np.datetime64(start_time) < start_time_in_dataset:
+    # the time index is in memory, nothing is read from the store
+    start_time_in_dataset, end_time_in_dataset = dataset.indexes["time"][[0, -1]].values
+    # parse the times once, pd.Timestamp also takes datetimes and np.datetime64
+    if np.datetime64(pd.Timestamp(start_time)) < start_time_in_dataset:
         warning1 = f"provided start {start_time} is before the start of the dataset "
         warning2 = f"{start_time_in_dataset}, selecting from {start_time_in_dataset}"
         warning = warning1 + warning2
         logger.warning(warning)
         start_time = start_time_in_dataset
-    if np.datetime64(end_time) > end_time_in_dataset:
+    if np.datetime64(pd.Timestamp(end_time)) > end_time_in_dataset:
         warning1 = f"provided end {end_time} is after the end of the dataset "
-        warning2 = "{end_time_in_dataset}, selecting until {end_time_in_dataset}"
+        warning2 = f"{end_time_in_dataset}, selecting until {end_time_in_dataset}"
         warning = warning1 + warning2
         logger.warning(warning)
         end_time = end_time_in_dataset
@@ -143,111 +271,614 @@ def clip_dataset_to_bounds(
     """
     # check time range here in case just this function is imported and not the whole module
     start_time, end_time = validate_time_range(dataset, start_time, end_time)
-    dataset = dataset.sel(
-        x=slice(bounds[0], bounds[2]+0.01), # buffer added to deal with weird skinny geometries
-        y=slice(bounds[1], bounds[3]+0.01),
-        time=slice(start_time, end_time),
-    )
+    dataset = dataset.isel(get_bounds_indexers(dataset, bounds, start_time, end_time))
     logger.debug(slice(bounds[0], bounds[2]+0.01))
     logger.debug(slice(bounds[1], bounds[3]+0.01))
     logger.info("Selected time range and clipped to bounds")
     return dataset
 
 
-def compute_store(stores: xr.Dataset, cached_nc_path: Path) -> xr.Dataset:
-    """Compute the store and save it to a cached netCDF file."""
-    logger.info("Downloading and caching forcing data, this may take a while")
+def get_bounds_indexers(
+    dataset: xr.Dataset, bounds: Tuple[float, float, float, float], start_time: str, end_time: str
+) -> dict:
+    '''
+    Find the cells of a dataset in the bounds and the time range. The labels
+    are looked up in the in memory indexes of the dataset, the coordinates are
+    not read again.
 
-    # sort of terrible work around for half downloaded files
-    temp_path = cached_nc_path.with_suffix(".downloading.nc")
-    if os.path.exists(temp_path):
-        os.remove(temp_path)
+    Parameters
+    ----------
+    dataset : xr.Dataset
+        Dataset with x, y and time coordinates.
+    bounds : tuple[float, float, float, float]
+        Corners of bounding box, as in clip_dataset_to_bounds.
+    start_time : str
+        Desired start time.
+    end_time : str
+        Desired end time.
+
+    Returns
+    -------
+    dict
+        {dimension: slice of positions} for dataset.isel.
+    '''
+    return {
+        # buffer added to deal with weird skinny geometries
+        "x": dataset.indexes["x"].slice_indexer(bounds[0], bounds[2] + 0.01),
+        "y": dataset.indexes["y"].slice_indexer(bounds[1], bounds[3] + 0.01),
+        "time": dataset.indexes["time"].slice_indexer(start_time, end_time),
+    }
+
+
+def open_cached_store(cached_nc_path: Path) -> xr.Dataset:
+    '''
+    Open a zarr store written by compute_store. The arrays are chunked like the
+    store, with the chunks it was written with, so every dask chunk reads
+    whole zarr chunks. The packed variables are unpacked to float32.
+    '''
+    data = xr.open_zarr(cached_nc_path, consolidated=True, chunks={})
+    # xarray unpacks int16 with an add_offset to float64, the cast is fused into
+    # the tasks that read the chunks. astype drops the encoding, which holds the
+    # zarr chunks of the store.
+    for var in data.data_vars:
+        if data[var].dtype == np.float64:
+            encoding = data[var].encoding
+            data[var] = data[var].astype("float32")
+            data[var].encoding = encoding
+    return data
 
+
+def cast_to_float32(stores: xr.Dataset) -> xr.Dataset:
+    '''
+    Cast the forcing variables to float32 and clip them to their packing
+    range, so they can be written to the cache.
+    '''
     ## Cast every single variable to float32 to save space to save a lot of memory issues later
     ## easier to do it now in this slow download step than later in the steps without dask
+    # crs is a coordinate, astype only casts the data variables
+    stores = stores.astype("float32")
+    # values outside of the packing range are clipped so they don't overflow int16
+    return stores.assign({
+        var: clip_to_packing_range(stores[var], var) for var in stores.data_vars
+    })
+
+
+def get_cache_encoding(stores: xr.Dataset) -> dict:
+    '''
+    Return the zarr encoding of a cache, stores has to be chunked with
+    get_aligned_chunks already.
+    '''
+    # variables with a known range are packed into int16, which halves the size
+    # of the cache, the others stay float32. open_cached_store unpacks them to float32.
+    encoding = {}
+    for var in stores.data_vars:
+        encoding[var] = get_packing(var) or {"dtype": "float32"}
+        encoding[var]["chunks"] = tuple(chunks[0] for chunks in stores[var].chunks)
+        encoding[var]["compressor"] = CACHE_COMPRESSOR
+    # the time coordinate would keep the chunks of the first source store, store
+    # it as a single chunk so opening the cache reads it in one request
+    encoding["time"] = {"chunks": (stores.sizes["time"],)}
+    return encoding
+
+
+def get_source_chunks(stores: xr.Dataset) -> dict:
+    '''
+    Return the zarr chunks of the source stores of lazy forcing data, as
+    {dimension: chunk length}. The encoding of the source stores has to be kept
+    (before cast_to_float32).
+    '''
+    # all the forcing variables have the same chunks
+    source_chunks = {}
     for var in stores.data_vars:
-        if var != "crs":
-            stores[var] = stores[var].astype("float32")
+        if "chunks" in stores[var].encoding:
+            source_chunks.update(zip(stores[var].dims, stores[var].encoding["chunks"]))
+    return source_chunks
 
-    client = Client.current()
-    future = client.compute(stores.to_netcdf(temp_path, compute=False))
-    # Display progress bar
-    progress(future)
-    future.result()
 
-    os.rename(temp_path, cached_nc_path)
+def snap_to_source_chunks(stores: xr.Dataset, indexers: dict) -> dict:
+    '''
+    Widen the y and x slices of indexers outwards to the boundaries of the zarr
+    chunks of the source stores. A cache written from the selected data then
+    starts at a source chunk, so its chunks are aligned to the source chunks.
+    The whole source chunks are downloaded either way.
 
-    data = xr.open_mfdataset(cached_nc_path, parallel=True, engine="h5netcdf")
+    Parameters
+    ----------
+    stores : xr.Dataset
+        Lazy forcing data that hasn't been clipped yet.
+    indexers : dict
+        {dimension: slice of positions}, see get_bounds_indexers.
+
+    Returns
+    -------
+    dict
+        indexers with the widened y and x slices.
+    '''
+    source_chunks = get_source_chunks(stores)
+    snapped = dict(indexers)
+    # the yearly stores along time don't share one grid of chunks
+    for dim in ("y", "x"):
+        source = source_chunks.get(dim)
+        if source is None:
+            continue
+        cells = indexers[dim]
+        snapped[dim] = slice(cells.start // source * source,
+                             min(ceil(cells.stop / source) * source, stores.sizes[dim]))
+    return snapped
+
+
+def get_aligned_chunks(stores: xr.Dataset) -> dict:
+    '''
+    Return the dask chunks to write a cache with. Each dimension is chunked
+    with its CACHE_CHUNKS length. When that length isn't a multiple of the
+    zarr chunks of the source stores, it is rounded to the nearest multiple.
+    The chunks are only aligned to the source chunks when stores starts at a
+    source chunk along y and x, see snap_to_source_chunks.
+
+    Parameters
+    ----------
+    stores : xr.Dataset
+        Lazy forcing data, the encoding of the source stores has to be kept
+        (before cast_to_float32).
+
+    Returns
+    -------
+    dict
+        {dimension: chunk length}.
+    '''
+    source_chunks = get_source_chunks(stores)
+    # the dask chunks follow the source chunks, the first one is shorter when the
+    # data starts inside a source chunk
+    first_var = stores[list(stores.data_vars)[0]]
+    dask_chunks = dict(zip(first_var.dims, first_var.chunks or ()))
+
+    chunks = {}
+    for dim, size in CACHE_CHUNKS.items():
+        if dim not in stores.dims:
+            continue
+        source = source_chunks.get(dim)
+        if source is None:
+            chunks[dim] = size
+            continue
+        if size % source != 0:
+            size = max(1, round(size / source)) * source
+            logger.info("Cache chunks along %s are not a multiple of the source chunks of %s, "
+                        "using chunks of %s", dim, source, size)
+        chunks[dim] = size
+        if dim in ("y", "x") and len(dask_chunks.get(dim, ())) > 1 and \
+           dask_chunks[dim][0] % source != 0:
+            offset = source - dask_chunks[dim][0] % source
+            # a cache chunk starts offset cells into a source chunk, so it spans
+            # one more source chunk than it covers and a task reads all of them
+            n_read = ceil((offset + size) / source)
+            logger.warning("The data starts %s cells into a source chunk of %s along %s, each "
+                           "cache chunk would read %s source chunks to write %s", offset,
+                           source, dim, n_read, size // source)
+    return chunks
+
+
+def compute_store(stores: xr.Dataset, cached_nc_path: Path) -> xr.Dataset:
+    """Compute the store and save it to a cached zarr store."""
+    logger.info("Downloading and caching forcing data, this may take a while")
+    if stores.sizes["time"] == 0:
+        raise ValueError(f"No timesteps to write to {cached_nc_path}, the time range is empty")
+
+    # sort of terrible work around for half downloaded files
+    temp_path = cached_nc_path.with_suffix(".downloading.zarr")
+    if temp_path.exists():
+        shutil.rmtree(temp_path)
+
+    chunks = get_aligned_chunks(stores)
+    stores = cast_to_float32(stores)
+    # every dask chunk has to cover whole zarr chunks, so the data is rechunked
+    # to uniform chunks that are also used for the store
+    stores = stores.chunk(chunks)
+    # fuse the cast into the tasks that read the chunks from S3
+    (stores,) = dask.optimize(stores)
+
+    # the data is downloaded and written one slice of time at a time, so the
+    # workers only hold the tasks of one slice and the memory use doesn't grow
+    # with the length of the time range. The slices are whole time chunks.
+    encoding = get_cache_encoding(stores)
+    slice_length = ceil(TIMESTEPS_PER_WRITE / chunks["time"]) * chunks["time"]
+    n_slices = ceil(stores.sizes["time"] / slice_length)
+    client = _get_client()
+    for i, start in enumerate(range(0, stores.sizes["time"], slice_length)):
+        time_slice = stores.isel(time=slice(start, start + slice_length))
+        # every slice has its own progress bar, labelled by this line
+        logger.info("Writing time slice %s of %s (%s to %s)", i + 1, n_slices,
+                    time_slice.indexes["time"][0], time_slice.indexes["time"][-1])
+        if start == 0:
+            write = time_slice.to_zarr(temp_path, mode="w", consolidated=True,
+                                       compute=False, encoding=encoding)
+        else:
+            # the encoding is taken from the store
+            write = time_slice.to_zarr(temp_path, append_dim="time", consolidated=True,
+                                       compute=False)
+        future = client.compute(write)
+        progress(future)
+        future.result()
+        # release the results of the slice before the next one is submitted, the
+        # tasks that open the source stores have the same keys in every slice
+        del future
+
+    # the store is a directory, the rename is atomic on the same filesystem
+    temp_path.replace(cached_nc_path)
+
+    data = open_cached_store(cached_nc_path)
     return data
 
 
+def append_to_store(stores: xr.Dataset, cached_nc_path: Path) -> xr.Dataset:
+    '''
+    Append timesteps that come after the end of a cached zarr store to it, the
+    variables and the grid have to be the same as in the cache.
+
+    Parameters
+    ----------
+    stores : xr.Dataset
+        Lazy forcing data of the missing timesteps.
+    cached_nc_path : Path
+        Path of the zarr store written by compute_store.
+
+    Returns
+    -------
+    xr.Dataset
+        The cached data including the appended timesteps.
+    '''
+    logger.info("Downloading forcing data missing from the cache")
+    cached_data = open_cached_store(cached_nc_path)
+    stores = cast_to_float32(stores)
+
+    # the chunks of the cache, see get_aligned_chunks
+    cached_var = cached_data[next(iter(stores.data_vars))]
+    chunks = dict(zip(cached_var.dims, cached_var.encoding["chunks"]))
+    # the first dask chunk fills the last, partial zarr chunk of the cache, so
+    # every dask chunk still covers whole zarr chunks
+    time_chunk = chunks["time"]
+    n_times = stores.sizes["time"]
+    first_chunk = min(n_times, time_chunk - cached_data.sizes["time"] % time_chunk)
+    time_chunks = [first_chunk] + [time_chunk] * ((n_times - first_chunk) // time_chunk)
+    if sum(time_chunks) < n_times:
+        time_chunks.append(n_times - sum(time_chunks))
+    chunks["time"] = tuple(time_chunks)
+    stores = stores.chunk(chunks)
+    (stores,) = dask.optimize(stores)
+
+    # the encoding, including the packing, is taken from the cache. xarray checks
+    # the dask chunks against the zarr chunks without the offset of the append
+    # and rejects the short first chunk. Every zarr chunk is still written by a
+    # single dask chunk, so the check is turned off.
+    client = _get_client()
+    try:
+        future = client.compute(stores.to_zarr(cached_nc_path, append_dim="time",
+                                               consolidated=True, compute=False,
+                                               safe_chunks=False))
+        progress(future)
+        future.result()
+        merge_time_chunks(cached_nc_path)
+    except BaseException:
+        # the append writes into the cache itself and can't be rolled back, a
+        # partly appended cache is removed so the next run rebuilds it
+        logger.warning("Appending to the cache failed, removing %s", cached_nc_path)
+        shutil.rmtree(cached_nc_path, ignore_errors=True)
+        raise
+
+    return open_cached_store(cached_nc_path)
+
+
+def merge_time_chunks(cached_nc_path: Path) -> None:
+    '''
+    Rewrite the time coordinate of a cached zarr store as a single chunk. The
+    chunk is sized to the time range of the first write, so appending along
+    time splits the coordinate into more chunks.
+    '''
+    group = zarr.open_group(str(cached_nc_path), mode="r+")
+    time = group["time"]
+    if time.chunks[0] >= time.shape[0]:
+        return
+    values = time[:]
+    # the attributes hold the dimension and the units of the time values
+    attrs = time.attrs.asdict()
+    # the merged coordinate is written in full next to the old one and then
+    # moved into place, so the store is only without a time array between the
+    # delete and the rename
+    merged = group.create_dataset("time_merged", data=values, chunks=values.shape,
+                                  dtype=time.dtype, compressor=time.compressor,
+                                  fill_value=time.fill_value, overwrite=True)
+    merged.attrs.update(attrs)
+    del group["time"]
+    group.move("time_merged", "time")
+    zarr.consolidate_metadata(str(cached_nc_path))
+
+
+def load_forcing_vars(start_time: str, end_time: str, needed_vars: list[str]) -> xr.Dataset:
+    '''Open the AORC stores of the years from start_time to end_time, with only needed_vars.'''
+    logger.info("Loading zarr stores")
+    start_year = pd.Timestamp(start_time).year
+    end_year = pd.Timestamp(end_time).year + 1
+    lazy_store = load_aorc_zarr_datasets(start_year, end_year)
+    logger.debug("Got zarr stores")
+    # only the requested variables are downloaded
+    return lazy_store[needed_vars]
+
+
+def create_shared_store(lazy_store: xr.Dataset, shared_path: Path) -> None:
+    '''
+    Create a zarr store over the whole grid of lazy_store without downloading
+    any of its data. The store is filled one block of CACHE_CHUNKS y and x cells
+    at a time by fill_shared_store, DOWNLOADED_BLOCKS flags the filled blocks.
+    '''
+    logger.info("Creating shared forcing cache %s", shared_path)
+    # the variables are empty dask arrays with the dtype and the attributes of
+    # the cache. Even without compute, writing lazy_store itself would build and
+    # optimize the graph that downloads the whole grid.
+    stores = xr.Dataset(
+        {var: (lazy_store[var].dims,
+               dask.array.empty(lazy_store[var].shape, dtype="float32",
+                                chunks=tuple(CACHE_CHUNKS.get(dim, -1)
+                                             for dim in lazy_store[var].dims)),
+               lazy_store[var].attrs)
+         for var in lazy_store.data_vars},
+        coords=lazy_store.coords,
+        attrs=lazy_store.attrs,
+    )
+    encoding = get_cache_encoding(stores)
+    n_blocks = [ceil(stores.sizes[dim] / CACHE_CHUNKS[dim]) for dim in ("y", "x")]
+    stores[DOWNLOADED_BLOCKS] = (("y_block", "x_block"), np.zeros(n_blocks, dtype=np.int8))
+    # every flag is its own chunk, so blocks can be flagged in parallel
+    encoding[DOWNLOADED_BLOCKS] = {"chunks": (1, 1)}
+    # without compute only the metadata, the coordinates and the flags are
+    # written, the forcing variables stay empty
+    stores.to_zarr(shared_path, mode="w", consolidated=True, compute=False, encoding=encoding)
+
+
+def fill_shared_store(lazy_store: xr.Dataset,
+                      shared_path: Path,
+                      blocks: list[Tuple[int, int]]) -> None:
+    '''
+    Download blocks of the forcing data and write each one into its region of
+    a store created by create_shared_store.
+
+    Parameters
+    ----------
+    lazy_store : xr.Dataset
+        Lazy forcing data with the same grid and timesteps as the store.
+    shared_path : Path
+        Path of the shared zarr store.
+    blocks : list[Tuple[int, int]]
+        (y block, x block) index of every block to download.
+    '''
+    logger.info("Downloading %s blocks of forcing data into the shared cache", len(blocks))
+    # only the forcing variables are written, the coordinates are in the store
+    stores = cast_to_float32(lazy_store).drop_vars(["time", "y", "x", "crs"])
+    # the blocks are downloaded and written one slice of time at a time, as in
+    # compute_store, so the workers only hold the tasks of one slice. The slices
+    # are whole time chunks of the store.
+    time_chunk = CACHE_CHUNKS["time"]
+    slice_length = ceil(TIMESTEPS_PER_WRITE / time_chunk) * time_chunk
+    n_slices = ceil(stores.sizes["time"] / slice_length)
+    client = _get_client()
+    for i, start in enumerate(range(0, stores.sizes["time"], slice_length)):
+        logger.info("Writing time slice %s of %s", i + 1, n_slices)
+        times = slice(start, min(start + slice_length, stores.sizes["time"]))
+        writes = []
+        for y_block, x_block in blocks:
+            # the regions are whole zarr chunks, different blocks never write to
+            # the same chunk
+            region = {
+                "time": times,
+                "y": slice(y_block * CACHE_CHUNKS["y"], (y_block + 1) * CACHE_CHUNKS["y"]),
+                "x": slice(x_block * CACHE_CHUNKS["x"], (x_block + 1) * CACHE_CHUNKS["x"]),
+            }
+            block = stores.isel(region)
+            region = {dim: slice(region[dim].start, region[dim].start + block.sizes[dim])
+                      for dim in region}
+            block = block.chunk({dim: size for dim, size in CACHE_CHUNKS.items()
+                                 if dim in block.dims})
+            # blocks of no data, e.g. over the ocean, are not written at all
+            writes.append(block.to_zarr(shared_path, region=region, consolidated=False,
+                                        compute=False, write_empty_chunks=False))
+        futures = client.compute(writes)
+        progress(futures)
+        client.gather(futures)
+        # release the results of the slice before the next one is submitted
+        del futures
+
+    # flag the blocks once every slice of their data is written
+    for y_block, x_block in blocks:
+        flag = xr.Dataset({DOWNLOADED_BLOCKS: (("y_block", "x_block"), np.ones((1, 1), np.int8))})
+        flag.to_zarr(shared_path, consolidated=False,
+                     region={"y_block": slice(y_block, y_block + 1),
+                             "x_block": slice(x_block, x_block + 1)})
+
+
+def get_shared_forcing_data(
+    shared_path: Path,
+    start_time: str,
+    end_time: str,
+    gdf: gpd.GeoDataFrame,
+    needed_vars: list[str],
+) -> xr.Dataset:
+    '''
+    Get forcing data from a zarr store shared by many basins. The store covers
+    the whole AORC grid over the time range of the first call. Only the blocks
+    of the store that intersect the bounds of gdf and that no earlier call
+    downloaded yet are downloaded.
+
+    Parameters
+    ----------
+    shared_path : Path
+        Path of the shared zarr store, it is created if it doesn't exist.
+    start_time : str
+        Desired start time.
+    end_time : str
+        Desired end time.
+    gdf : gpd.GeoDataFrame
+        Geometries that the forcing data is clipped to.
+    needed_vars : list[str]
+        Names of the forcing variables in the AORC stores.
+
+    Returns
+    -------
+    xr.Dataset
+        Forcing data clipped to the bounds of gdf and the time range.
+    '''
+    if not shared_path.exists():
+        lazy_store = load_forcing_vars(start_time, end_time, needed_vars)
+        start_time, end_time = validate_time_range(lazy_store, start_time, end_time)
+        create_shared_store(lazy_store.sel(time=slice(start_time, end_time)), shared_path)
+
+    shared_data = open_cached_store(shared_path)
+    missing_vars = set(needed_vars) - set(shared_data.data_vars)
+    if len(missing_vars) > 0:
+        # the store is shared, it can't be rebuilt for a single basin
+        raise ValueError(f"Shared cache {shared_path} doesn't have the forcing vars "
+                         f"{sorted(missing_vars)}")
+    if not range_in_store(shared_data, start_time, end_time):
+        # only do this if the time range is not in the store as it is slow, the
+        # store was created with the range clamped to the source data, e.g. an
+        # end of 2030 is stored until the end of the source
+        lazy_store = load_forcing_vars(start_time, end_time, needed_vars)
+        start_time, end_time = validate_time_range(lazy_store, start_time, end_time)
+        if not range_in_store(shared_data, start_time, end_time):
+            time_index = shared_data.indexes["time"]
+            raise ValueError(f"Shared cache {shared_path} has the time range {time_index[0]} "
+                             f"to {time_index[-1]}, not {start_time} to {end_time}")
+    gdf = gdf.to_crs(shared_data.crs.esri_pe_string)
+    bounds = gdf.total_bounds
+
+    # the same selection as clip_dataset_to_bounds
+    cells = get_bounds_indexers(shared_data, bounds, start_time, end_time)
+    y_cells, x_cells = cells["y"], cells["x"]
+    y_blocks = range(y_cells.start // CACHE_CHUNKS["y"], ceil(y_cells.stop / CACHE_CHUNKS["y"]))
+    x_blocks = range(x_cells.start // CACHE_CHUNKS["x"], ceil(x_cells.stop / CACHE_CHUNKS["x"]))
+    downloaded = shared_data[DOWNLOADED_BLOCKS].values
+    blocks = [(y_block, x_block) for y_block in y_blocks for x_block in x_blocks
+              if not downloaded[y_block, x_block]]
+
+    if len(blocks) > 0:
+        # the blocks are written over the whole time range of the store, which
+        # can be longer than the range of this call. Every variable of the store
+        # is downloaded, a block is flagged as a whole and the store can hold
+        # more variables than this call needs. The opened stores are reused,
+        # see open_zarr_stores.
+        time_index = shared_data.indexes["time"]
+        store_vars = [var for var in shared_data.data_vars if var != DOWNLOADED_BLOCKS]
+        lazy_store = load_forcing_vars(time_index[0], time_index[-1], store_vars)
+        lazy_store = lazy_store.sel(time=slice(time_index[0], time_index[-1]))
+        fill_shared_store(lazy_store, shared_path, blocks)
+        shared_data = open_cached_store(shared_path)
+    else:
+        logger.info("Forcing data is in the shared cache")
+
+    return clip_dataset_to_bounds(shared_data.drop_vars(DOWNLOADED_BLOCKS),
+                                  bounds, start_time, end_time)
+
+
+def range_in_store(dataset: xr.Dataset, start_time: str, end_time: str) -> bool:
+    '''Check that the time range from start_time to end_time is in dataset.'''
+    time_index = dataset.indexes["time"]
+    return time_index[0] <= pd.Timestamp(start_time) and time_index[-1] >= pd.Timestamp(end_time)
+
+
 def get_forcing_data(
     cached_nc_path: Path,
     start_time: str,
     end_time: str,
     gdf: gpd.GeoDataFrame,
     forcing_vars: list[str] = None,
+    region_write: bool = False,
 ) -> xr.Dataset:
-    """Get forcing data from zarr datasets, clip to bounds and cache to netCDF file."""
+    """
+    Get forcing data from zarr datasets, clip to bounds and cache to a zarr store.
+    With region_write, cached_nc_path is a store shared by every call, see
+    get_shared_forcing_data.
+    """
     merged_data = None
-
-    if os.path.exists(cached_nc_path):
-        logger.info("Found cached nc file")
-        # open the cached file and check that the time range is correct
-        cached_data = xr.open_mfdataset(
-            cached_nc_path, parallel=True, engine="h5netcdf"
-        )
-        range_in_cache = cached_data.time[0].values <= np.datetime64(
-            start_time
-        ) and cached_data.time[-1].values >= np.datetime64(end_time)
-
+    cached_data = None
+    # only the requested variables are downloaded
+    needed_vars = [AORC_VARIABLES.get(var, var) for var in forcing_vars or AORC_VARIABLES]
+    if region_write:
+        return get_shared_forcing_data(cached_nc_path, start_time, end_time, gdf, needed_vars)
+
+    if cached_nc_path.exists():
+        logger.info("Found cached zarr store")
+        # open the cached store and check that the variables and the time range
+        # are in it, this only reads the local store
+        cached_data = open_cached_store(cached_nc_path)
         gdf = gdf.to_crs(cached_data.crs.esri_pe_string)
 
-        if not range_in_cache:
-            # only do this if the time range is not in the cache as it is slow
-            # this catches cases where a user entered 2030 as the end on the first run and
-            # the cache only goes to 2023
-            # it will prevent the cache from being deleted and reloaded every time
-            lazy_store = load_zarr_datasets()
-            start_time, end_time = validate_time_range(lazy_store, start_time, end_time)
-
-        if forcing_vars:
-            # check if the forcing vars are all in the cached data
-            # the zarr file names dont exactly match the forcing vars within them
-            cached_vars = cached_data.data_vars.keys()
-            cached_vars = [var.lower() for var in cached_vars if var != "crs"]
-            # replace rainrate with precip
-            cached_vars = [var.replace("rainrate", "precip") for var in cached_vars]
-            missing_vars = set(forcing_vars) - set(cached_vars)
-            if len(missing_vars) > 0:
-                logger.info("Missing forcing vars in cache: %s", missing_vars)
-                range_in_cache = False
-
-        if range_in_cache:
+        # the zarr file names dont exactly match the forcing vars within them
+        missing_vars = set(needed_vars) - set(cached_data.data_vars)
+        if len(missing_vars) > 0:
+            logger.info("Missing forcing vars in cache: %s", missing_vars)
+            shutil.rmtree(cached_nc_path)
+            logger.debug("Removed cached zarr store")
+            cached_data = None
+        elif range_in_store(cached_data, start_time, end_time):
             logger.info("Time range is within cached data")
-            logger.debug("Opened cached nc file: [%s]", cached_nc_path)
+            logger.debug("Opened cached zarr store: [%s]", cached_nc_path)
             merged_data = clip_dataset_to_bounds(
                 cached_data, gdf.total_bounds, start_time, end_time
             )
             logger.debug("Clipped stores")
-        else:
-            logger.info("Time range is incorrect")
-            os.remove(cached_nc_path)
-            logger.debug("Removed cached nc file")
 
     if merged_data is None:
-        logger.info("Loading zarr stores")
         # create new event loop
         # lazy_store = load_zarr_datasets(forcing_vars)
-        start_year = int(start_time.split("-")[0])
-        end_year = int(end_time.split("-")[0]) + 1
-        lazy_store = load_aorc_zarr_datasets(start_year, end_year)
+        lazy_store = load_forcing_vars(start_time, end_time, needed_vars)
         gdf = gdf.to_crs(lazy_store.crs.esri_pe_string)  # for retro
-        logger.debug("Got zarr stores")
-        clipped_store = clip_dataset_to_bounds(lazy_store, gdf.total_bounds, start_time, end_time)
-        logger.info("Clipped forcing data to bounds")
+        # this catches cases where a user entered 2030 as the end on the first run and
+        # the cache only goes to 2023
+        # it will prevent the cache from being deleted and reloaded every time
+        start_time, end_time = validate_time_range(lazy_store, start_time, end_time)
+
+        if cached_data is not None:
+            cache_start = cached_data.indexes["time"][0]
+            cache_end = cached_data.indexes["time"][-1]
+            if range_in_store(cached_data, start_time, end_time):
+                logger.info("Time range is within cached data")
+                merged_data = cached_data
+            elif cache_start <= pd.Timestamp(start_time):
+                # only the end is missing, download the timesteps after the
+                # cache on the grid of the cache and append them
+                logger.info("Appending time range missing from cached data")
+                # every variable of the cache is appended, it can hold more
+                # variables than this call needs. The source is opened from the
+                # end of the cache, the request can start after it. The opened
+                # stores are reused.
+                source = load_forcing_vars(cache_end, end_time, list(cached_data.data_vars))
+                tail = source.sel(
+                    x=slice(cached_data.x.values[0], cached_data.x.values[-1]),
+                    y=slice(cached_data.y.values[0], cached_data.y.values[-1]),
+                    time=slice(cache_end, end_time),
+                )
+                # the tail starts at the last cached timestep, so the appended
+                # timesteps directly follow the cache and the store has no gap
+                contiguous = tail.sizes["time"] > 1 and tail.indexes["time"][0] == cache_end
+                tail = tail.isel(time=slice(1, None))
+                if contiguous and tail.sizes["x"] == cached_data.sizes["x"] and \
+                   tail.sizes["y"] == cached_data.sizes["y"]:
+                    merged_data = append_to_store(tail, cached_nc_path)
+            if merged_data is None:
+                logger.info("Time range is incorrect")
+                shutil.rmtree(cached_nc_path)
+                logger.debug("Removed cached zarr store")
+            else:
+                merged_data = clip_dataset_to_bounds(
+                    merged_data, gdf.total_bounds, start_time, end_time
+                )
+
+    if merged_data is None:
+        # the cache holds the whole source chunks around the bounds, so its chunks
+        # are aligned to the source chunks, and is clipped once it is written
+        indexers = get_bounds_indexers(lazy_store, gdf.total_bounds, start_time, end_time)
+        clipped_store = lazy_store.isel(snap_to_source_chunks(lazy_store, indexers))
+        logger.info("Clipped forcing data to the source chunks around the bounds")
         logger.debug(lazy_store.head())
         merged_data = compute_store(clipped_store, cached_nc_path)
+        merged_data = clip_dataset_to_bounds(merged_data, gdf.total_bounds, start_time, end_time)
         logger.info("Forcing data loaded and cached")
         # close the event loop
 